@@ -10,49 +10,105 @@ import scipy.special
 import scipy.io
 import pickle
 import os
+import zipfile
+import ast
 import warnings
 
 from . import glhmm
 from . import auxiliary
 
+def read_headers(file):
+    """
+    Reads the shapes and dtypes of the variables stored in a .mat or .npz file, without loading them.
+    All .npy format versions (1.0, 2.0 and 3.0) are supported within .npz files.
+    The dtype is None for .mat files, as the Matlab class does not determine it
+    (e.g. complex data are reported as 'double').
+    """
+
+    if file[-4:] == '.mat':
+        return {name: (shape,None) for name,shape,_ in scipy.io.whosmat(file)}
+
+    headers = {}
+    with zipfile.ZipFile(file) as z:
+        for name in z.namelist():
+            with z.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                # header length takes 2 bytes in version 1.0 and 4 bytes afterwards;
+                # the header is latin1 text up to version 2.0 and utf8 in version 3.0
+                hlen = int.from_bytes(f.read(2 if version == (1,0) else 4),'little')
+                header = f.read(hlen).decode('utf8' if version >= (3,0) else 'latin1')
+                header = ast.literal_eval(header)
+            headers[name[:-4]] = (tuple(header['shape']),
+                np.lib.format.descr_to_dtype(header['descr']))
+    return headers
+
+
+def copy_rows(M,t,A,shape,dtypes):
+    """
+    Copies A into rows t of M and returns M. M is allocated with the given shape 
+    on the first call (M is None), and its dtype is promoted whenever A requires it.
+    """
+
+    if M is None: 
+        M = np.empty(shape,dtype=np.result_type(A.dtype,*dtypes))
+    elif np.result_type(M.dtype,A.dtype) != M.dtype: 
+        M = M.astype(np.result_type(M.dtype,A.dtype))
+    np.copyto(M[t],A)
+    return M
+
+
 def load_files(files,I=None,do_only_indices=False):
     """
     Loads data from files and returns the loaded data, indices, and individual indices for each file.
+    The files are first scanned for their dimensions and dtypes, so that the data of each file 
+    can be copied straight into preallocated arrays; the dtype of .mat data is only known 
+    once loaded, so the arrays are promoted if a .mat file needs a wider dtype.
     """       
 
-    X = []
-    Y = []
+    X = None
+    Y = None
     indices = []
     indices_individual = []
-    sum_T = 0
 
     if I is None:
         I = np.arange(len(files))
     elif type(I) is int:
         I = np.array([I])
 
+    # first pass: dimensions and dtypes of the data in each file
+    headers = [read_headers(files[I[ij]]) for ij in range(I.shape[0])]
+    name_Y = ['Y' if 'Y' in h else 'X' for h in headers]
+    has_X = [('X' in h) and ('Y' in h) for h in headers]
+    # as when concatenating, X only has rows for the files that contain it
+    offsets_Y = np.concatenate(([0],np.cumsum([h[name][0][0] for h,name in zip(headers,name_Y)])))
+    offsets_X = np.concatenate(([0],np.cumsum([h['X'][0][0] if hx else 0 
+        for h,hx in zip(headers,has_X)])))
+    shape_Y = (offsets_Y[-1],) + headers[0][name_Y[0]][0][1:]
+    dtypes_Y = [h[name][1] for h,name in zip(headers,name_Y) if h[name][1] is not None]
+    if any(has_X):
+        hX = [h['X'] for h,hx in zip(headers,has_X) if hx]
+        shape_X = (offsets_X[-1],) + hX[0][0][1:]
+        dtypes_X = [dtype for _,dtype in hX if dtype is not None]
+
+    # second pass: load each file and copy its data into place
     for ij in range(I.shape[0]):
 
         j = I[ij]
 
-        # if type(files[j]) is tuple:
-        #     if len(files[j][0]) > 0: # X
-        #         if files[j][0][-4:] == '.npy':
-        #             X.append(np.load(files[j][0]))
-        #         elif files[j][0][-4:] == '.txt':
+        if do_only_indices: variable_names = ['indices','T']
+        elif has_X[ij]: variable_names = ['X','Y','indices','T']
+        else: variable_names = [name_Y[ij],'indices','T']
 
         if files[j][-4:] == '.mat':
-            dat = scipy.io.loadmat(files[j])
+            dat = scipy.io.loadmat(files[j],variable_names=variable_names)
 
         elif files[j][-4:] == '.npz':
             dat = np.load(files[j])
             
         if not do_only_indices:
-            if ('X' in dat) and (not 'Y' in dat): 
-                Y.append(dat["X"])
-            else:
-                if 'X' in dat: X.append(dat["X"])
-                Y.append(dat["Y"])
+            Y = copy_rows(Y,slice(offsets_Y[ij],offsets_Y[ij+1]),dat[name_Y[ij]],shape_Y,dtypes_Y)
+            if has_X[ij]: 
+                X = copy_rows(X,slice(offsets_X[ij],offsets_X[ij+1]),dat["X"],shape_X,dtypes_X)
         if 'indices' in dat: 
             ind = dat['indices']
         elif 'T' in dat:
@@ -60,19 +116,17 @@ def load_files(files,I=None,do_only_indices=False):
         else:
             ind = np.zeros((1,2)).astype(int)
             ind[0,0] = 0
-            ind[0,1] = Y[-1].shape[0]
+            ind[0,1] = offsets_Y[ij+1] - offsets_Y[ij]
         if len(ind.shape) == 1: ind = np.expand_dims(ind,axis=0)
         indices_individual.append(ind)
-        indices.append(ind + sum_T)
+        indices.append(ind + offsets_Y[ij])
 
-        sum_T += dat["Y"].shape[0]
+        if files[j][-4:] == '.npz': dat.close()
+        del dat
 
-    if not do_only_indices:
-        if len(X) > 0: X = np.concatenate(X)
-        Y = np.concatenate(Y)
+    if do_only_indices: Y = []
     indices = np.concatenate(indices)
     if len(indices.shape) == 1: indices = np.expand_dims(indices,axis=0)
-    if len(X) == 0: X = None
 
     return X,Y,indices,indices_individual
 
@@ -10,6 +10,8 @@ import numpy as np
 import warnings
 from sklearn.decomposition import PCA
 from scipy import signal
+from scipy import linalg
+from numba import njit, prange
 
 from . import auxiliary
 # import auxiliary
@@ -28,7 +30,10 @@ def apply_pca(X,d,whitening=False,exact=True):
     whitening : bool, default=False
         Whether to whiten the transformed data.
     exact : bool, default=True
-        Whether to use full SVD solver for PCA.
+        Whether to compute the PCA from a full (thin) SVD of the data;
+        otherwise a randomized SVD (with a fixed seed) is used when d is a number 
+        of components below min(n_samples, n_parcels)//5, and scikit-learn's PCA 
+        chooses the solver in any other case.
 
     Returns:
     --------
@@ -36,32 +41,130 @@ def apply_pca(X,d,whitening=False,exact=True):
         The transformed data after applying PCA.
     """
     if type(d) is np.ndarray:
-        X -= np.mean(X,axis=0)
+        # project first and center after, (X - m) @ d = X @ d - m @ d,
+        # so that X is neither modified nor copied
         X = X @ d
-        if whitening: X /= np.std(X,axis=0)
+        X -= np.mean(X,axis=0)
+        # X is now centered, so the std is just the root mean square
+        if whitening: X /= np.sqrt(np.einsum('ij,ij->j',X,X) / X.shape[0])
         return X
 
-    svd_solver = 'full' if exact else 'auto'
-    if d >= 1: 
-        pcamodel = PCA(n_components=d,whiten=whitening,svd_solver=svd_solver)
+    if exact:
+        if (d >= 1) and (d > min(X.shape)):
+            raise ValueError("d=%r must be between 0 and min(n_samples, n_parcels)=%r" \
+                % (d,min(X.shape)))
+        # thin SVD of the centered data, X = U * s * V' (signs are set below)
+        U,s,_ = linalg.svd(X - np.mean(X,axis=0),full_matrices=False,overwrite_a=True)
+        if d >= 1: d = int(d)
+        else: d = np.where(np.cumsum(s**2) / np.sum(s**2) >= d)[0][0] + 1
+        if whitening: X = U[:,0:d] * np.sqrt(X.shape[0]-1)
+        else: X = U[:,0:d] * s[0:d]
+    elif d >= 1: 
+        if d < min(X.shape) // 5: # few components: randomized SVD
+            pcamodel = PCA(n_components=d,whiten=whitening,svd_solver='randomized',
+                random_state=0,n_oversamples=10,power_iteration_normalizer='LU')
+        else:
+            pcamodel = PCA(n_components=d,whiten=whitening,svd_solver='auto')
         pcamodel.fit(X)
         X = pcamodel.transform(X)
     else: 
-        pcamodel = PCA(whiten=whitening,svd_solver=svd_solver)
+        pcamodel = PCA(whiten=whitening,svd_solver='auto')
         pcamodel.fit(X)
         ncomp = np.where(np.cumsum(pcamodel.explained_variance_ratio_)>=d)[0][0] + 1
         X = pcamodel.transform(X)
         X = X[:,0:ncomp]
         d = ncomp
 
-    # sign convention equal to Matlab's
-    for j in range(d):
-        jj = np.where(np.abs(X[:,j]) == np.abs(np.max(X[:,j])) )[0][0]
-        if X[jj,j] < 0: X[:,j] *= -1
+    # sign convention equal to Matlab's: the largest absolute value of each component is positive
+    jj = np.argmax(np.abs(X),axis=0)
+    X *= np.where(X[jj,np.arange(X.shape[1])] < 0, -1.0, 1.0)
 
     return X
 
 
+def standardise_sessions(data,indices,do_std=True):
+    """Centers, and optionally scales to unit variance, each trial/session of data in place.
+
+    Parameters:
+    -----------
+    data : array-like of shape (n_samples, n_parcels)
+        The data timeseries, modified in place; it must be float32 or float64.
+    indices : array-like of shape (n_sessions, 2)
+        The start and end indices of each trial/session in the input data.
+    do_std : bool, default=True
+        Whether to also divide each session by its standard deviation.
+
+    """
+    if data.dtype not in (np.float32,np.float64):
+        raise TypeError("data must be a float32 or float64 array, as it is modified in place")
+    _standardise_sessions(data,np.ascontiguousarray(indices,dtype=np.int64),do_std)
+
+
+@njit(parallel=True,cache=True,error_model='numpy')
+def _standardise_sessions(data,indices,do_std):
+    # compiled kernel of standardise_sessions, which checks the dtype of data
+    N = indices.shape[0]
+    p = data.shape[1]
+    for j in range(N): # no bounds checking below
+        if indices[j,0] < 0 or indices[j,0] > indices[j,1] or indices[j,1] > data.shape[0]:
+            raise ValueError("indices must satisfy 0 <= start <= end <= data.shape[0]")
+    for j in prange(N):
+        t0,t1 = indices[j,0],indices[j,1]
+        m = np.zeros(p)
+        for t in range(t0,t1):
+            for c in range(p): m[c] += data[t,c]
+        m /= (t1 - t0)
+        s = np.zeros(p)
+        for t in range(t0,t1):
+            for c in range(p):
+                data[t,c] -= m[c]
+                s[c] += data[t,c] ** 2
+        if do_std:
+            s = np.sqrt(s / (t1 - t0))
+            for t in range(t0,t1):
+                for c in range(p): data[t,c] /= s[c]
+
+
+def detrend_sessions(data,indices):
+    """Removes the least-squares linear trend of each trial/session of data in place.
+
+    Parameters:
+    -----------
+    data : array-like of shape (n_samples, n_parcels)
+        The data timeseries, modified in place; it must be float32 or float64.
+    indices : array-like of shape (n_sessions, 2)
+        The start and end indices of each trial/session in the input data.
+
+    """
+    if data.dtype not in (np.float32,np.float64):
+        raise TypeError("data must be a float32 or float64 array, as it is modified in place")
+    _detrend_sessions(data,np.ascontiguousarray(indices,dtype=np.int64))
+
+
+@njit(parallel=True,cache=True)
+def _detrend_sessions(data,indices):
+    # compiled kernel of detrend_sessions, which checks the dtype of data
+    N = indices.shape[0]
+    p = data.shape[1]
+    for j in range(N): # no bounds checking below
+        if indices[j,0] < 0 or indices[j,0] > indices[j,1] or indices[j,1] > data.shape[0]:
+            raise ValueError("indices must satisfy 0 <= start <= end <= data.shape[0]")
+    for j in prange(N):
+        t0,t1 = indices[j,0],indices[j,1]
+        n = t1 - t0
+        tm = (n - 1) / 2 # mean time point within the session
+        m = np.zeros(p)
+        b = np.zeros(p)
+        for t in range(t0,t1):
+            for c in range(p): 
+                m[c] += data[t,c]
+                b[c] += (t - t0 - tm) * data[t,c]
+        m /= n
+        if n > 1: b /= n * (n**2 - 1) / 12 # sum of squared centered time points
+        for t in range(t0,t1):
+            for c in range(p): data[t,c] -= m[c] + b[c] * (t - t0 - tm)
+
+
 def preprocess_data(data,indices,
         fs = 1, # frequency of the data
         standardise=True, # True / False
@@ -94,6 +197,7 @@ def preprocess_data(data,indices,
         The low-pass and high-pass thresholds to apply to the input data.
         If None, no filtering will be applied.
         If a tuple, the first element is the low-pass threshold and the second is the high-pass threshold.
+        The filter of each trial/session starts at steady state for its first sample.
 
     detrend : bool, default=False
         Whether to detrend the input data.
@@ -110,7 +214,10 @@ def preprocess_data(data,indices,
         Whether to whiten the input data after applying PCA.
 
     exact_pca : bool, default=True
-        Whether to use full SVD solver for PCA.
+        Whether to compute the PCA from a full (thin) SVD of the data;
+        otherwise a randomized SVD (with a fixed seed) is used when pca is a number 
+        of components below min(n_samples, n_parcels)//5, and scikit-learn's PCA 
+        chooses the solver in any other case.
 
     downsample : int or float or None, default=None
         The new frequency of the input data after downsampling.
@@ -125,16 +232,22 @@ def preprocess_data(data,indices,
         The start and end indices of each trial/session in the preprocessed data.
 
     """
+    indices = np.ascontiguousarray(indices,dtype=np.int64)
+    if np.any(indices[:,0] < 0) or np.any(indices[:,0] > indices[:,1]) \
+            or np.any(indices[:,1] > data.shape[0]):
+        raise ValueError("indices must satisfy 0 <= start <= end <= data.shape[0]")
     p = data.shape[1]
-    N = indices.shape[0]
+    T = indices[:,1] - indices[:,0]
 
-    data = np.copy(data)
+    # copy only if some step works on data in place, or nothing else would;
+    # the copy is floating point, as all steps produce non-integer values
+    in_place = standardise or (filter != None) or detrend or onpower
+    if in_place or ((pca is None) and (downsample is None)): 
+        dtype = data.dtype if data.dtype in (np.float32,np.float64) else np.float64
+        data = np.array(data,dtype=dtype)
 
     if standardise:
-        for j in range(N):
-            t = np.arange(indices[j,0],indices[j,1]) 
-            data[t,:] -= np.mean(data[t,:],axis=0)
-            data[t,:] /= np.std(data[t,:],axis=0)   
+        standardise_sessions(data,indices)
 
     if filter != None:
         filterorder = 6
@@ -144,36 +257,41 @@ def preprocess_data(data,indices,
             sos = signal.butter(filterorder, filter[0], 'highpass', output='sos', fs = fs)
         else:
             sos = signal.butter(filterorder, filter, 'bandpass', output='sos', fs = fs)
-        for j in range(N):
-            t = np.arange(indices[j,0],indices[j,1])
-            data[t,:] = signal.sosfilt(sos, data[t,:], axis=0)
+        # initial conditions at steady state for the first sample of each session,
+        # to avoid the startup transient at the beginning of each session
+        zi = signal.sosfilt_zi(sos)[:,:,np.newaxis] # (sections, 2, channels)
+        for j in range(indices.shape[0]):
+            t = slice(indices[j,0],indices[j,1])
+            data[t,:],_ = signal.sosfilt(sos, data[t,:], axis=0, zi=zi*data[indices[j,0],:])
 
     if detrend:
-        for j in range(N):
-            t = np.arange(indices[j,0],indices[j,1]) 
-            data[t,:] = signal.detrend(data[t,:], axis=0)       
+        detrend_sessions(data,indices)
 
     if onpower:
-        for j in range(N):
-            t = np.arange(indices[j,0],indices[j,1]) 
+        for j in range(indices.shape[0]):
+            t = slice(indices[j,0],indices[j,1])
             data[t,:] = np.abs(signal.hilbert(data[t,:], axis=0))
 
-    if pca != None:
+    if pca is not None:
         data = apply_pca(data,pca,whitening,exact_pca)
         p = data.shape[1]
         
     if downsample != None:
         factor = downsample / fs
-        Tnew = np.ceil(factor * (indices[:,1]-indices[:,0])).astype(int)
+        Tnew = np.ceil(factor * T).astype(int)
         indices_new = auxiliary.make_indices_from_T(Tnew)
         data_new = np.zeros((np.sum(Tnew),p))
         gcd = math.gcd(downsample,fs)
-        for j in range(N):
-            t = np.arange(indices[j,0],indices[j,1]) 
-            tnew = np.arange(indices_new[j,0],indices_new[j,1]) 
-            data_new[tnew,:] = signal.resample_poly(data[t,:], downsample/gcd, fs/gcd)
-            # Tjnew = tnew.shape[0]
-            # data_new[tnew,:] = signal.resample(data[t,:], Tjnew)     
+        up,down = downsample // gcd, fs // gcd
+        # anti-aliasing filter designed once, the same that resample_poly would use
+        max_rate = max(up,down)
+        h = signal.firwin(20 * max_rate + 1, 1 / max_rate, window=('kaiser',5.0))
+        # one resampling call for each group of sessions with the same length
+        for Tj in np.unique(T):
+            jj = np.where(T==Tj)[0]
+            t = indices[jj,0][:,np.newaxis] + np.arange(Tj) # (sessions by time)
+            tnew = indices_new[jj,0][:,np.newaxis] + np.arange(Tnew[jj[0]])
+            data_new[tnew,:] = signal.resample_poly(data[t,:], up, down, axis=1, window=h)
         data = data_new
     else: indices_new = indices
 
@@ -212,6 +330,7 @@ def build_data_autoregressive(data,indices,autoregressive_order=1,
 
     """
 
+    indices = np.ascontiguousarray(indices,dtype=np.int64)
     T,p = data.shape
     N = indices.shape[0]
 
@@ -221,19 +340,21 @@ def build_data_autoregressive(data,indices,autoregressive_order=1,
     
     X = np.zeros((T - N*autoregressive_order,p*autoregressive_order))
     Y = np.zeros((T - N*autoregressive_order,p))
-    indices_new = np.zeros((N,2))
+    indices_new = np.zeros((N,2)).astype(int)
+    # (time, lag, channel) view of X, as columns are ordered lag-major, channel-minor
+    X_3d = X.reshape(X.shape[0],autoregressive_order,p)
 
     for j in range(N):
-        ind_1 = np.arange(indices[j,0]+autoregressive_order,indices[j,1],dtype=np.int64)
-        ind_2 = np.arange(indices[j,0],indices[j,1]-autoregressive_order,dtype=np.int64) \
-            - j * autoregressive_order
+        t0,t1 = indices[j,0],indices[j,1]
+        ind_1 = slice(t0+autoregressive_order,t1)
+        ind_2 = slice(t0 - j * autoregressive_order,t1 - (j+1) * autoregressive_order)
         Y[ind_2,:] = data[ind_1,:]
-        for i in range(autoregressive_order):
-            ind_3 = np.arange(indices[j,0]+autoregressive_order-(i+1),indices[j,1]-(i+1),dtype=np.int64)
-            ind_ch = np.arange(p) + i * p
-            X[ind_2,ind_ch[:,np.newaxis]] = data[ind_3,:].T
-        indices_new[j,0] = ind_2[0]
-        indices_new[j,1] = ind_2[-1] + 1
+        # (time, channel, lag) view, with the lags reversed so that lag 1 comes first
+        X_w = np.lib.stride_tricks.sliding_window_view(data[t0:t1-1,:],
+            autoregressive_order,axis=0)[:,:,::-1]
+        X_3d[ind_2,:,:] = X_w.transpose(0,2,1)
+        indices_new[j,0] = ind_2.start
+        indices_new[j,1] = ind_2.stop
 
     # center
     if center_data:
@@ -242,29 +363,22 @@ def build_data_autoregressive(data,indices,autoregressive_order=1,
 
     if connectivity is not None:
         # connectivity_new : (regressors by regressed) 
-        connectivity_new = np.zeros((autoregressive_order*p,p))
-        for i in range(autoregressive_order):
-            ind_ch = np.arange(p) + i * p
-            connectivity_new[ind_ch,:] = connectivity
+        connectivity_new = np.tile(connectivity,(autoregressive_order,1)).astype(float)
         # regress out when asked
+        XX = X.T @ X + 0.001 * np.eye(X.shape[1])
+        XY = X.T @ Y
+        B = np.zeros((X.shape[1],p)) # zero for the regressors that are kept
         for j in range(p):
             jj = np.where(connectivity_new[:,j]==0)[0]
             if len(jj)==0: continue
-            b = np.linalg.inv(X[:,jj].T @ X[:,jj] + 0.001 * np.eye(len(jj))) \
-                @ (X[:,jj].T @ Y[:,j])
-            Y[:,j] -= X[:,jj] @ b
+            B[jj,j] = linalg.cho_solve(linalg.cho_factor(XX[np.ix_(jj,jj)]),XY[jj,j])
+        Y -= X @ B
         # remove unused variables
-        active_X = np.zeros(p,dtype=bool)
-        active_Y = np.zeros(p,dtype=bool)
-        for j in range(p):
-            active_X[j] = np.sum(connectivity[j,:]==1) > 0
-            active_Y[j] = np.sum(connectivity[:,j]==1) > 0
-        active_X = np.tile(active_X,autoregressive_order)
-        active_X = np.where(active_X)[0]
-        active_Y = np.where(active_Y)[0]
+        active_X = np.tile((connectivity==1).any(axis=1),autoregressive_order)
+        active_Y = (connectivity==1).any(axis=0)
         Y = Y[:,active_Y]
         X = X[:,active_X]
-        connectivity_new = connectivity_new[active_X,active_Y[:,np.newaxis]].T
+        connectivity_new = connectivity_new[np.ix_(active_X,active_Y)]
     else: connectivity_new = None
 
     return X,Y,indices_new,connectivity_new
@@ -300,37 +414,33 @@ def build_data_partial_connectivity(X,Y,connectivity=None,center_data=True):
         The matrix has the same structure as `connectivity` after removing unused predictors and targets.
     """
 
-    X_new = np.copy(X)
+    if center_data: X_new = X - np.mean(X,axis=0)
+    else: X_new = np.copy(X)
     Y_new = np.copy(Y)
 
     if connectivity is not None:
         p = X.shape[1]
         q = Y.shape[1]
         # regress out when asked
+        XX = X.T @ X + 0.001 * np.eye(p)
+        XY = X.T @ Y
+        B = np.zeros((p,q)) # zero for the regressors that are kept
         for j in range(q):
             jj = np.where(connectivity[:,j]==0)[0]
             if len(jj)==0: continue
-            b = np.linalg.inv(X[:,jj].T @ X[:,jj] + 0.001 * np.eye(len(jj))) \
-                @ (X[:,jj].T @ Y[:,j])
-            Y_new[:,j] -= X[:,jj] @ b
+            B[jj,j] = linalg.cho_solve(linalg.cho_factor(XX[np.ix_(jj,jj)]),XY[jj,j])
+        Y_new -= X @ B
         # remove unused variables
-        active_X = np.zeros(p,dtype=bool)
-        for j in range(p): active_X[j] = np.sum(connectivity[j,:]==1) > 0
-        active_Y = np.zeros(q,dtype=bool)
-        for j in range(q): active_Y[j] = np.sum(connectivity[:,j]==1) > 0
-        active_X = np.where(active_X)[0]
-        active_Y = np.where(active_Y)[0]
+        active_X = (connectivity==1).any(axis=1)
+        active_Y = (connectivity==1).any(axis=0)
         Y = Y[:,active_Y]
         X = X[:,active_X]
-        # copy of connectivity
-        connectivity_new = np.copy(connectivity)
-        connectivity_new = connectivity_new[active_X,active_Y[:,np.newaxis]].T
+        # (fancy indexing returns a copy of connectivity)
+        connectivity_new = connectivity[np.ix_(active_X,active_Y)]
     else: connectivity_new = None
 
-    # center
-    if center_data:
-        Y_new = Y_new - np.mean(Y_new,axis=0)
-        X_new = X_new - np.mean(X_new,axis=0)
+    # center (X_new was centered when copied)
+    if center_data: Y_new -= np.mean(Y_new,axis=0)
 
     return X_new,Y_new,connectivity_new
 
@@ -365,6 +475,7 @@ def build_data_tde(data,indices,lags,pca=None,standardise_pc=True):
     if pca is None, then no PCA is run.
     """
 
+    indices = np.ascontiguousarray(indices,dtype=np.int64)
     T,p = data.shape
     N = indices.shape[0]
     
@@ -372,27 +483,27 @@ def build_data_tde(data,indices,lags,pca=None,standardise_pc=True):
     minlag = np.min(lags)
     maxlag = np.max(lags)
     rwindow = maxlag-minlag
+    # position of each lag within a window of rwindow+1 consecutive time points
+    ind_lags = maxlag - np.array(lags)
 
     X = np.zeros((T - N*rwindow,p*L))
     indices_new = np.zeros((N,2)).astype(int)
 
     # Embedding
     for j in range(N):
-        ind_1 = np.arange(indices[j,0],indices[j,1],dtype=np.int64)
-        ind_2 = np.arange(indices[j,0],indices[j,1]-rwindow,dtype=np.int64) - j * rwindow
-        for i in range(L):
-            l = lags[i]
-            X_l = np.roll(data[ind_1,:],l,axis=0)
-            X_l = X_l[-minlag:-maxlag,:]
-            ind_ch = np.arange(i,L*p,L)
-            X[ind_2,ind_ch[:,np.newaxis]] = X_l.T
-        indices_new[j,0] = ind_2[0]
-        indices_new[j,1] = ind_2[-1] + 1
+        t0,t1 = indices[j,0],indices[j,1]
+        ind_1 = slice(t0,t1)
+        ind_2 = slice(t0 - j * rwindow,t1 - (j+1) * rwindow)
+        # (time, channel, window) view; columns are ordered channel-major, lag-minor
+        X_w = np.lib.stride_tricks.sliding_window_view(data[ind_1,:],rwindow+1,axis=0)
+        X[ind_2,:] = X_w[:,:,ind_lags].reshape(-1,p*L)
+        indices_new[j,0] = ind_2.start
+        indices_new[j,1] = ind_2.stop
 
     # Standardise (in Matlab's HMM-MAR we only centered pre-embedding)
     # note that this is done for the entire data set and not per sessions
     X -= np.mean(X,axis=0)
-    X /= np.std(X,axis=0)
+    X /= np.sqrt(np.einsum('ij,ij->j',X,X) / X.shape[0])
 
     # PCA and whitening 
     if pca is not None: